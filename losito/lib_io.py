@@ -2,14 +2,67 @@
 """
 Library for Logger, ParsetParser and progressbar
 """
-import os, logging, glob, sys, time
-from configparser import ConfigParser
-from io import StringIO
+import os, logging, glob, sys, time, re, fnmatch, shutil, bisect
+from configparser import ConfigParser, ParsingError, DuplicateSectionError, DuplicateOptionError
+
+_magic_check = re.compile('[*?[]')
+_glob_cache = {}
+
+
+def _glob_patterns(patterns):
+    """
+    Expand several glob patterns, scanning every parent directory only once.
+    Patterns with magic in the directory part or with '**' are passed to
+    glob.glob. Results are cached per pattern until the next parset file
+    is loaded.
+
+    Parameters
+    ----------
+    patterns : list of str
+        Unix-style filename patterns.
+
+    Returns
+    -------
+    matches : dict
+        Dict of {pattern: list of matching filenames}
+    """
+    matches = {}
+    by_dir = {}
+    for pattern in patterns:
+        if pattern in _glob_cache:
+            matches[pattern] = _glob_cache[pattern]
+            continue
+        dirname, basename = os.path.split(pattern)
+        if '**' in pattern or _magic_check.search(dirname) or not _magic_check.search(basename):
+            matches[pattern] = _glob_cache[pattern] = glob.glob(pattern)
+        else:
+            by_dir.setdefault(dirname, []).append(pattern)
+
+    for dirname, dir_patterns in by_dir.items():
+        try:
+            with os.scandir(dirname or os.curdir) as it:
+                names = [entry.name for entry in it]
+        except OSError:
+            names = []
+        for pattern in dir_patterns:
+            basename = os.path.basename(pattern)
+            match = re.compile(fnmatch.translate(basename)).match
+            # like glob, hidden files only match patterns starting with '.'
+            hidden = basename.startswith('.')
+            files = [os.path.join(dirname, name) for name in names
+                     if match(name) and (hidden or not name.startswith('.'))]
+            matches[pattern] = _glob_cache[pattern] = files
+    return matches
+
+
+# tokenized parset files, keyed by (absolute filename, modification time)
+_parset_cache = {}
 
 
 class ParsetParser(ConfigParser):
     """
-    A parser for losito parset files.
+    A parser for losito parset files. Values are read raw, '%' has no
+    special meaning (no interpolation).
 
     Parameters
     ----------
@@ -18,63 +71,148 @@ class ParsetParser(ConfigParser):
     """
 
     def __init__(self, parsetFile):
-        ConfigParser.__init__(self, inline_comment_prefixes=('#', ';'))
+        ConfigParser.__init__(self, inline_comment_prefixes=('#', ';'), interpolation=None)
+        # files may have been created or removed since the last parset
+        _glob_cache.clear()
+        # reuse the tokenized file if it was parsed before and is unchanged
+        key = (os.path.abspath(parsetFile), os.stat(parsetFile).st_mtime_ns)
+        if key not in _parset_cache:
+            _parset_cache[key] = self._fast_parse(parsetFile)
+        self.read_dict(_parset_cache[key], source=parsetFile)
+
+        # extract all values once, the getters below only do dict lookups
+        self._cache = {}
+        for section in self.sections():
+            for key, value in self.items(section, raw=True):
+                self._cache[(section, key.lower())] = value
+        self._arraycache = {}
+
+    def _fast_parse(self, parsetFile):
+        """
+        Tokenize a parset file in a single pass. Options before the first
+        section header are put in the [_global] section.
 
-        config = StringIO()
-        # add [_global] fake section at beginning
-        config.write('[_global]\n'+open(parsetFile).read())
-        config.seek(0, os.SEEK_SET)
-        self.read_file(config)
+        Returns
+        -------
+        sections : dict
+            Dict of {section: {option: value}}
+        """
+        section = '_global'
+        sections = {section: {}}
+        options = sections[section]
+        option = None
+        indent_level = 0
+        with open(parsetFile) as f:
+            for lineno, line in enumerate(f, start=1):
+                line = line.rstrip('\r\n')
+                stripped = line.strip()
+                if not stripped:
+                    # empty lines are kept inside multi-line values
+                    if option is not None:
+                        options[option] += '\n'
+                    continue
+                if stripped[0] in self._comment_prefixes:
+                    continue
+                # inline comments need a whitespace before the prefix
+                for i in range(1, len(stripped)):
+                    if stripped[i] in self._inline_comment_prefixes and stripped[i-1].isspace():
+                        stripped = stripped[:i].rstrip()
+                        break
+                indent = len(line) - len(line.lstrip())
+                if option is not None and indent > indent_level:
+                    # continuation, indented deeper than the option line
+                    options[option] += '\n' + stripped
+                    continue
+                indent_level = indent
+                if stripped[0] == '[' and ']' in stripped:
+                    section = stripped[1:stripped.rindex(']')]
+                    if section in sections:
+                        raise DuplicateSectionError(section, parsetFile, lineno)
+                    options = sections[section] = {}
+                    option = None
+                else:
+                    # split on the first delimiter, as ConfigParser does
+                    delims = [stripped.find(d) for d in self._delimiters if d in stripped]
+                    if not delims or min(delims) == 0:
+                        error = ParsingError(parsetFile)
+                        error.append(lineno, repr(line))
+                        raise error
+                    delim = min(delims)
+                    option = self.optionxform(stripped[:delim].rstrip())
+                    if option in options:
+                        raise DuplicateOptionError(section, option, parsetFile, lineno)
+                    options[option] = stripped[delim+1:].lstrip()
+        # trailing empty lines are not part of a value
+        for options in sections.values():
+            for option, value in options.items():
+                options[option] = value.rstrip()
+        return sections
+
+    def _lookup(self, s, v):
+        """
+        Return the raw value of option v in section s, or None if not present
+        """
+        return self._cache.get((s, v.lower()))
 
     def checkSpelling(self, s, availValues=[]):
         """
         check if any value in the step is missing from a value list and return a warning
         """
-        entries = [x.lower() for x in list(dict(self.items(s)).keys())]
-        availValues = ['soltab', 'operation'] + availValues
-        availValues = [x.lower() for x in availValues]
-        for e in entries:
-            if e not in availValues:
-                logger.warning('Mispelled option: %s - Ignoring!' % e)
+        avail = {x.lower() for x in ['soltab', 'operation'] + availValues}
+        for e in self.options(s):
+            if e.lower() not in avail:
+                logger.warning('Mispelled option: %s - Ignoring!' % e.lower())
 
     def getstr(self, s, v, default=None):
-        if self.has_option(s, v):
-            return str(self.get(s, v).replace('\'', '').replace('"', ''))  # remove apex
+        value = self._lookup(s, v)
+        if value is not None:
+            return value.replace('\'', '').replace('"', '')  # remove apex
         elif default is None:
             logger.error('Section: %s - Values: %s: required (expected string).' % (s, v))
         else:
             return default
 
     def getbool(self, s, v, default=None):
-        if self.has_option(s, v):
-            return ConfigParser.getboolean(self, s, v)
+        value = self._lookup(s, v)
+        if value is not None:
+            if value.lower() not in self.BOOLEAN_STATES:
+                raise ValueError('Not a boolean: %s' % value)
+            return self.BOOLEAN_STATES[value.lower()]
         elif default is None:
             logger.error('Section: %s - Values: %s: required (expected bool).' % (s, v))
         else:
             return default
 
     def getfloat(self, s, v, default=None):
-        if self.has_option(s, v):
-            return ConfigParser.getfloat(self, s, v)
+        value = self._lookup(s, v)
+        if value is not None:
+            return float(value)
         elif default is None:
             logger.error('Section: %s - Values: %s: required (expected float).' % (s, v))
         else:
             return default
 
     def getint(self, s, v, default=None):
-        if self.has_option(s, v):
-            return ConfigParser.getint(self, s, v)
+        value = self._lookup(s, v)
+        if value is not None:
+            return int(value)
         elif default is None:
             logger.error('Section: %s - Values: %s: required (expected int).' % (s, v))
         else:
             return default
 
     def getarray(self, s, v, default=None):
-        if self.has_option(s, v):
+        key = (s, v.lower())
+        if key in self._arraycache:
+            return list(self._arraycache[key])
+        if key in self._cache:
             try:
-                return self.getstr(s, v).replace(' ', '').replace('[', '').replace(']', '').split(',')  # split also turns str into 1-element lists
+                array = self.getstr(s, v).replace(' ', '').replace('[', '').replace(']', '').split(',')  # split also turns str into 1-element lists
             except:
                 logger.error('Error interpreting section: %s - values: %s (should be a list as [xxx,yyy,zzz...])' % (s, v))
+            else:
+                self._arraycache[key] = array
+                return list(array)
         elif default is None:
             logger.error('Section: %s - Values: %s: required.' % (s, v))
         else:
@@ -82,25 +220,26 @@ class ParsetParser(ConfigParser):
 
     def getarraystr(self, s, v, default=None):
         try:
-            return [str(x) for x in self.getarray(s, v, default)]
+            return list(map(str, self.getarray(s, v, default)))
         except:
             logger.error('Error interpreting section: %s - values: %s (expected array of str.)' % (s, v))
 
     def getarraybool(self, s, v, default=None):
         try:
-            return [bool(x) for x in self.getarray(s, v, default)]
+            # bool('False') is True, so map the strings like getbool does
+            return [self.BOOLEAN_STATES[str(x).lower()] for x in self.getarray(s, v, default)]
         except:
             logger.error('Error interpreting section: %s - values: %s (expected array of bool.)' % (s, v))
 
     def getarrayfloat(self, s, v, default=None):
         try:
-            return [float(x) for x in self.getarray(s, v, default)]
+            return list(map(float, self.getarray(s, v, default)))
         except:
             logger.error('Error interpreting section: %s - values: %s (expected array of float.)' % (s, v))
 
     def getarrayint(self, s, v, default=None):
         try:
-            return [int(x) for x in self.getarray(s, v, default)]
+            return list(map(int, self.getarray(s, v, default)))
         except:
             logger.error('Error interpreting section: %s - values: %s (expected array of int.)' % (s, v))
 
@@ -108,9 +247,10 @@ class ParsetParser(ConfigParser):
         "Unix-style filename matching including regex"
         regstring = self.getstr(s, v, default)
         regstring = regstring.split(' ')
+        matches = _glob_patterns(regstring)
         filenames = []
         for split in regstring:
-            files_matching_split = glob.glob(split)
+            files_matching_split = matches[split]
             if len(files_matching_split) == 0:
                 logger.warning('No matching files found for {}.'.format(split))
             filenames += files_matching_split
@@ -134,22 +274,22 @@ class Logger():
 
     def backup(self, logfile, log_dir):
 
+        current_time = time.localtime()
+        log_dir_old = time.strftime(f'{log_dir}_bkp_%Y-%m-%d_%H:%M', current_time)
+
         # bkp old log dir
         if os.path.isdir(log_dir):
             # os.system('rm -r {}'.format(log_dir))
             if not os.path.isdir(log_dir + '_bkp'):
                 os.mkdir(log_dir + '_bkp')
-            current_time = time.localtime()
-            log_dir_old = time.strftime(log_dir + '_bkp_%Y-%m-%d_%H:%M', current_time)
-            os.system('mv %s %s' % (log_dir, log_dir + '_bkp/' + log_dir_old))
+            shutil.move(log_dir, os.path.join(f'{log_dir}_bkp', log_dir_old))
         os.makedirs(log_dir)
 
         # bkp old log file
         if os.path.exists(logfile):
-            current_time = time.localtime()
-            logfile_old = time.strftime(logfile + '_bkp_%Y-%m-%d_%H:%M', current_time)
-            log_dir_old = time.strftime(log_dir + '_bkp_%Y-%m-%d_%H:%M', current_time)
-            os.system('mv %s %s' % (logfile, log_dir+'_bkp/'+log_dir_old+'/'+logfile_old))
+            logfile_old = time.strftime(f'{logfile}_bkp_%Y-%m-%d_%H:%M', current_time)
+            os.makedirs(os.path.join(f'{log_dir}_bkp', log_dir_old), exist_ok=True)
+            shutil.move(logfile, os.path.join(f'{log_dir}_bkp', log_dir_old, logfile_old))
             # os.system('rm {}'.format(logfile))
 
     def set_logger(self, logfile, log_dir):
@@ -158,7 +298,7 @@ class Logger():
         logger.setLevel(logging.INFO)
 
         # create file handler which logs even debug messages
-        handlerFile = logging.FileHandler(logfile)
+        handlerFile = _BufferedFileHandler(logfile)
         handlerFile.setLevel(logging.DEBUG)
 
         # create console handler with a higher log level
@@ -177,6 +317,34 @@ class Logger():
 logger = logging.getLogger("LoSiTo")
 
 
+class _BufferedFileHandler(logging.FileHandler):
+    """
+    File handler that writes through a buffer instead of flushing after
+    every record. The buffer is flushed when full, for records of level
+    WARNING and above, and by logging.shutdown() at exit.
+    """
+
+    def __init__(self, filename, buffersize=1 << 13, flushLevel=logging.WARNING):
+        self.buffersize = buffersize
+        self.flushLevel = flushLevel
+        logging.FileHandler.__init__(self, filename)
+
+    def _open(self):
+        # FileHandler has no errors attribute before Python 3.9
+        return open(self.baseFilename, self.mode, buffering=self.buffersize,
+                    encoding=self.encoding, errors=getattr(self, 'errors', None))
+
+    def emit(self, record):
+        if self.stream is None:
+            self.stream = self._open()
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+            if record.levelno >= self.flushLevel:
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
+
 class _ColorStreamHandler(logging.StreamHandler):
 
     DEFAULT = '\x1b[0m'
@@ -191,22 +359,20 @@ class _ColorStreamHandler(logging.StreamHandler):
     INFO     = GREEN
     DEBUG    = CYAN
 
+    # colors for levels >= the corresponding entry of _LEVELS
+    _LEVELS = (logging.DEBUG, logging.INFO, logging.WARNING, logging.ERROR, logging.CRITICAL)
+    _COLORS = (DEFAULT, DEBUG, INFO, WARNING, ERROR, CRITICAL)
+
     @classmethod
     def _get_color(cls, level):
-        if level >= logging.CRITICAL:  return cls.CRITICAL
-        elif level >= logging.ERROR:   return cls.ERROR
-        elif level >= logging.WARNING: return cls.WARNING
-        elif level >= logging.INFO:    return cls.INFO
-        elif level >= logging.DEBUG:   return cls.DEBUG
-        else:                          return cls.DEFAULT
+        return cls._COLORS[bisect.bisect_right(cls._LEVELS, level)]
 
     def __init__(self, stream=None):
         logging.StreamHandler.__init__(self, stream)
 
     def format(self, record):
-        color = self._get_color(record.levelno)
-        record.msg = color + record.msg + self.DEFAULT
-        return logging.StreamHandler.format(self, record)
+        # wrap the formatted line, the record is shared with the other handlers
+        return f'{self._get_color(record.levelno)}{logging.StreamHandler.format(self, record)}{self.DEFAULT}'
 
 # The MIT License (MIT)
 # Copyright (c) 2016 Vladimir Ignatev
@@ -233,17 +399,38 @@ library is python 2 and not supported anymore. In the future, it might be
 usefull to use the tqdm library for this: https://github.com/tqdm/tqdm """
 
 
+_IS_TTY = getattr(sys.stdout, 'isatty', lambda: False)()
+_BAR_LEN = 40
+_BAR_FULL = '=' * _BAR_LEN
+_BAR_EMPTY = '-' * _BAR_LEN
+_last_update = 0.
+
+
 def progress(count, total, status=''):
     '''Usage: place in for-loop like:
         for i, val in enumerate(vals):
             progress(i, len(vals), somestringcomment)
             ...
+    On a terminal the bar is redrawn at most ~30 times per second, otherwise
+    (pipes, log files) a line is only written every percent of progress.
     '''
-    bar_len = 40
-    filled_len = round(bar_len * count / float(total))
+    global _last_update
+    last = count >= total - 1
+    if _IS_TTY:
+        now = time.monotonic()
+        if now - _last_update < 1. / 30 and not last:
+            return
+        _last_update = now
+        end = '\r'
+    elif count % max(1, total // 100) == 0 or last:
+        end = '\n'
+    else:
+        return
+
+    filled_len = round(_BAR_LEN * count / float(total))
 
     percents = round(100.0 * count / float(total), 1)
-    bar = '=' * filled_len + '-' * (bar_len - filled_len)
+    bar = _BAR_FULL[:filled_len] + _BAR_EMPTY[filled_len:]
 
-    sys.stdout.write('[%s] %s%s ...%s\r' % (bar, percents, '%', status))
+    sys.stdout.write('[%s] %s%s ...%s%s' % (bar, percents, '%', status, end))
     sys.stdout.flush()
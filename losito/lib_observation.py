@@ -2,15 +2,22 @@
 Definition of the Observation and MS classes
 """
 import os
+import math
 import subprocess
 import casacore.tables as pt
 import numpy as np
 from astropy.time import Time
 from astropy.io import fits
+from astropy.coordinates import AltAz, EarthLocation, SkyCoord
+import astropy.units as u
 import lsmtool
 from .lib_io import logger
 import sys
-import ast
+import re
+import functools
+import contextlib
+import copy
+import datetime
 
 
 class MS:
@@ -25,20 +32,77 @@ class MS:
         Filename of the MS file
       """
 
+    # Attributes set by scan_ms() that are stored in the scan cache
+    _scan_attrs = ('times', 'starttime', 'endtime', 'timepersample', 'numsamples',
+                   'freq', 'referencefreq', 'startfreq', 'endfreq', 'numchannels',
+                   'channelwidth', 'ra', 'dec', 'stations', 'stationids',
+                   'numstations', 'diam', 'stationpositions', 'antennatype')
+    # Attributes only computed when first accessed, with the method that sets them
+    _lazy_attrs = {'mean_el_rad': 'scan_elevation', 'fwhm_deg': 'scan_elevation'}
+
     def __init__(self, ms_filename, starttime=None, endtime=None):
         self.ms_filename = ms_filename
-        # Scan the MS and store various observation parameters
-        self.scan_ms()
-
+        self._ro_table = None
+        # Scan the MS and store various observation parameters, unless a
+        # scan of the unchanged MS is cached on disk
+        if not self.load_scan_cache():
+            self.scan_ms()
+            self.save_scan_cache()
+
+    def __getattr__(self, name):
+        # Only called for attributes that are not set yet
+        if name in MS._lazy_attrs:
+            getattr(self, MS._lazy_attrs[name])()
+            self.save_scan_cache()
+            return self.__dict__[name]
+        raise AttributeError("'MS' object has no attribute '{}'".format(name))
+
+    @contextlib.contextmanager
     def table(self, readonly=True):
         """
-        Open and return the corresponding table. Don't forget to close.
+        Context manager yielding the corresponding table. The read-only
+        table is reused by nested read-only blocks and closed at the end of
+        the outermost one, so no handle stays open while e.g. DP3 writes to
+        the MS. A writable table is opened for the duration of the block.
 
-        Returns
-        -------
+        Parameters
+        ----------
+        readonly : bool, optional
+            Whether to open the table read-only
+
+        Yields
+        ------
         table : table-object
         """
-        return pt.table(self.ms_filename, ack=False, readonly=readonly)
+        if readonly:
+            if self._ro_table is not None:
+                yield self._ro_table
+                return
+            # Don't hold a read lock, so other processes can still write
+            self._ro_table = pt.table(self.ms_filename, ack=False, readonly=True,
+                                      lockoptions='autonoread')
+            try:
+                yield self._ro_table
+            finally:
+                self.close()
+        else:
+            # casacore shares one table object per process, close the
+            # read-only handle so the write lock is released with this one
+            self.close()
+            with pt.table(self.ms_filename, ack=False, readonly=False) as tab:
+                yield tab
+
+    def close(self):
+        """
+        Close the cached read-only table, if open.
+        """
+        if self._ro_table is not None:
+            self._ro_table.close()
+            self._ro_table = None
+
+    def __del__(self):
+        if self.__dict__.get('_ro_table') is not None:
+            self.close()
 
     def scan_ms(self):
         """
@@ -67,52 +131,126 @@ class MS:
           * stationpositions
           * antennatype
         """
-        tab = self.table()
-
-        # Get time info
-        self.times = np.unique(tab.getcol('TIME'))
-        assert (np.diff(self.times) >= 0).all(), self.ms_filename+" contains unordered timestamps."
-        self.starttime = np.min(self.times)
-        self.endtime = np.max(self.times)
-        self.timepersample = tab.getcell('EXPOSURE', 0)
-        self.numsamples = len(self.times)
-
-        # Get frequency info
-        self.freq = tab.SPECTRAL_WINDOW.getcol('CHAN_FREQ')[0]
-        assert (np.diff(self.freq) >= 0).all(), self.ms_filename+" contains unordered frequencies."
-        self.referencefreq = tab.SPECTRAL_WINDOW.getcol('REF_FREQUENCY')[0]
-        self.startfreq = np.min(self.freq)
-        self.endfreq = np.max(self.freq)
-        self.numchannels = len(self.freq)
-        self.channelwidth = tab.SPECTRAL_WINDOW.getcol('CHAN_WIDTH')[0]
-
-        # Get pointing info
-        self.ra = np.degrees(float(tab.FIELD.getcol('REFERENCE_DIR')[0][0, 0]))
-        if self.ra < 0.:
-            self.ra = 360.0 + (self.ra)
-        self.dec = np.degrees(float(tab.FIELD.getcol('REFERENCE_DIR')[0][0, 1]))
-
-        # Get station names, positions, and diameter
-        self.stations = tab.ANTENNA.getcol('NAME')
-        self.stationids = tab.ANTENNA.getcol('LOFAR_STATION_ID')
-
-        self.numstations = len(self.stations)
-        self.diam = float(tab.ANTENNA.getcol('DISH_DIAMETER')[0])
-        self.stationpositions = tab.ANTENNA.getcol('POSITION')
-        self.antennatype = tab.OBSERVATION.getcol('LOFAR_ANTENNA_SET')[0]
+        with self.table() as tab:
+
+            # Get time info. DISTINCT keeps the order of the rows, which need
+            # not be time-ordered (e.g. concatenated MSs), so sort the result
+            self.times = np.sort(pt.taql('SELECT DISTINCT TIME FROM $tab').getcol('TIME'))
+            self.starttime = self.times[0]
+            self.endtime = self.times[-1]
+            self.timepersample = tab.getcell('EXPOSURE', 0)
+            self.numsamples = len(self.times)
+
+            # Get frequency info
+            with tab.SPECTRAL_WINDOW as spw:
+                self.freq = spw.getcol('CHAN_FREQ')[0]
+                self.referencefreq = spw.getcol('REF_FREQUENCY')[0]
+                self.channelwidth = spw.getcol('CHAN_WIDTH')[0]
+            assert (self.freq[1:] >= self.freq[:-1]).all(), self.ms_filename+" contains unordered frequencies."
+            self.startfreq = self.freq[0]
+            self.endfreq = self.freq[-1]
+            self.numchannels = len(self.freq)
+
+            # Get pointing info
+            with tab.FIELD as field:
+                ref_dir = field.getcol('REFERENCE_DIR')[0]
+            self.ra = math.degrees(ref_dir[0, 0])
+            if self.ra < 0.:
+                self.ra += 360.0
+            self.dec = math.degrees(ref_dir[0, 1])
+
+            # Get station names, positions, and diameter
+            with tab.ANTENNA as ant:
+                self.stations = np.asarray(ant.getcol('NAME'))
+                self.stationids = ant.getcol('LOFAR_STATION_ID')
+                self.diam = float(ant.getcol('DISH_DIAMETER')[0])
+                self.stationpositions = ant.getcol('POSITION')
+            self.numstations = len(self.stations)
+
+            with tab.OBSERVATION as obs:
+                self.antennatype = obs.getcol('LOFAR_ANTENNA_SET')[0]
         if self.antennatype not in ['LBA_OUTER', 'LBA_INNER', 'LBA_SPARSE_EVEN', 'LBA_SPARSE_ODD', 'LBA_ALL',
                                     'HBA_DUAL_INNER']:
             logger.error('Antenna type not recognized (only LBA and HBA data '
                          'are supported)')
-        tab.close()
 
-        # Find mean elevation and FOV
-        el_values = pt.taql("SELECT mscal.azel1()[1] AS el from "
-                            + self.ms_filename + " limit ::10000").getcol("el")
-        self.mean_el_rad = np.mean(el_values)
+    def scan_elevation(self):
+        """
+        Find mean elevation and FOV. This is done on first access of
+        mean_el_rad or fwhm_deg.
+
+        ## Elevation
+          * mean_el_rad
+          * fwhm_deg
+        """
+        # The elevation of the pointing center is computed directly for at
+        # most ~200 timestamps as seen from the array center
+        stride = -(-self.numsamples // 200)
+        sample_times = Time(self.times[::stride] / (3600 * 24), format='mjd', scale='utc')
+        array_center = EarthLocation.from_geocentric(*np.mean(self.stationpositions, axis=0),
+                                                     unit=u.m)
+        pointing = SkyCoord(self.ra, self.dec, frame='fk5', unit=(u.deg, u.deg))
+        altaz = pointing.transform_to(AltAz(obstime=sample_times, location=array_center))
+        self.mean_el_rad = np.mean(altaz.alt.rad)
         sec_el = 1.0 / np.sin(self.mean_el_rad)
         self.fwhm_deg = 1.1 * ((3.0e8 / self.referencefreq) / self.diam) * 180. / np.pi * sec_el
 
+    # Subtables read by scan_ms(), their changes also invalidate the scan cache
+    _scan_subtables = ('SPECTRAL_WINDOW', 'FIELD', 'ANTENNA', 'OBSERVATION')
+
+    def _scan_cache_key(self):
+        """
+        Return the scan cache filename and the modification times (ns) of the
+        main table and of all files of the subtables read by scan_ms(), which
+        invalidate the cache when the MS is rewritten.
+        """
+        cache_filename = os.path.join(self.ms_filename, '.losito_scan.npz')
+        mtime = [os.stat(os.path.join(self.ms_filename, 'table.dat')).st_mtime_ns]
+        for subtable in self._scan_subtables:
+            with os.scandir(os.path.join(self.ms_filename, subtable)) as it:
+                mtime.append(max((entry.stat().st_mtime_ns for entry in it), default=0))
+        return cache_filename, np.array(mtime)
+
+    def load_scan_cache(self):
+        """
+        Load the results of scan_ms() from the cache file in the MS directory.
+
+        Returns
+        -------
+        loaded : bool
+            True if a valid cache was found and loaded.
+        """
+        try:
+            cache_filename, mtime = self._scan_cache_key()
+            with np.load(cache_filename) as cache:
+                if not np.array_equal(cache['mtime_ns'], mtime):
+                    return False
+                scan = {k: cache[k] for k in self._scan_attrs}
+                scan.update({k: cache[k] for k in self._lazy_attrs if k in cache})
+        except (OSError, KeyError, ValueError):
+            return False
+        for k, v in scan.items():
+            setattr(self, k, v.item() if v.ndim == 0 else v)
+        logger.debug('Using cached scan of {}'.format(self.ms_filename))
+        return True
+
+    def save_scan_cache(self):
+        """
+        Store the results of scan_ms() in a cache file in the MS directory.
+        The file is written to a temporary name first, so readers never see
+        a partial cache.
+        """
+        try:
+            cache_filename, mtime = self._scan_cache_key()
+            scan = {k: getattr(self, k) for k in self._scan_attrs}
+            scan.update({k: self.__dict__[k] for k in self._lazy_attrs if k in self.__dict__})
+            tmp_filename = cache_filename + '.{}.tmp'.format(os.getpid())
+            with open(tmp_filename, 'wb') as f:
+                np.savez(f, mtime_ns=mtime, **scan)
+            os.replace(tmp_filename, cache_filename)
+        except OSError as e:
+            logger.debug('Cannot write scan cache of {}: {}'.format(self.ms_filename, e))
+
     def get_times(self):
         """ Return array of times (ordered, with duplicates excluded) """
         return self.times
@@ -122,6 +260,19 @@ class MS:
         return self.freq
 
 
+# Start of the Modified Julian Date
+_MJD_EPOCH = datetime.datetime(1858, 11, 17)
+_MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct',
+           'Nov', 'Dec')
+
+# The last loaded sky model, keyed by (absolute filename, modification time)
+_skymodel_cache = {}
+
+# Structured dtype of the per-MS time information stored on Observation
+_MS_META_DTYPE = np.dtype([('starttime', 'f8'), ('endtime', 'f8'),
+                          ('timepersample', 'f8'), ('numsamples', 'i8')])
+
+
 class Observation:
     """
     The Observation object holds info on the observation and its processing parameters.
@@ -154,12 +305,11 @@ class Observation:
 
         # Check sky model and regions file
         self.input_skymodel_filename = skymodel_filename
-        try:
-            fits.open(self.input_skymodel_filename)
+        if self.is_fits(self.input_skymodel_filename):
             self.input_skymodel_type = 'fitsimage'
             self.output_skymodel_filename = None
             self.sourcedb_filename = None
-        except OSError:
+        else:
             self.input_skymodel_type = 'makesourcedb'
             self.output_skymodel_filename = skymodel_filename+'.losito'
             self.sourcedb_filename = self.output_skymodel_filename + '.sourcedb'
@@ -170,6 +320,8 @@ class Observation:
                             "the directions (facets) must be supplied.")
             sys.exit(1)
         self.regions_filename = regions_filename
+        self._patch_coords = None
+        self._patch_names = None
 
         # Load the sky model
         if skymodel_filename is not None:
@@ -177,8 +329,12 @@ class Observation:
 
         # Check MS files
         logger.info('Checking MS files')
-        self.ms_list = [MS(_file) for _file in
-                        self.ms_filenames]
+        self.ms_list = [MS(_file) for _file in self.ms_filenames]
+        self._times = None
+        self._freqs = None
+        # Time information of all MSs, one row per MS
+        self._ms_meta = np.array([(ms.starttime, ms.endtime, ms.timepersample, ms.numsamples)
+                                  for ms in self.ms_list], dtype=_MS_META_DTYPE)
         self.set_time()  # Set and test time information from MSs
         self.set_stations()  # Set station information from MSs
 
@@ -188,16 +344,7 @@ class Observation:
         self.initialize_parset_parameters()
 
     def __iter__(self):
-        self.index = 0
-        return self
-
-    def __next__(self):
-        try:
-            nextms = self.ms_list[self.index]
-        except IndexError:
-            raise StopIteration
-        self.index += 1
-        return nextms
+        return iter(self.ms_list)
 
     def __len__(self):
         return len(self.ms_list)
@@ -217,17 +364,27 @@ class Observation:
         """
         Loads the sky model
         """
+        # Patches may change with the sky model, reset the cached ones
+        self._patch_coords = None
+        self._patch_names = None
         if self.input_skymodel_type == 'makesourcedb':
-            # Set logging level to suppress confusing output from lsmtool
-            old_level = logger.root.getEffectiveLevel()
-            logger.root.setLevel('WARNING')
-            skymodel = lsmtool.load(self.input_skymodel_filename)
-            if not skymodel.hasPatches:
-                logger.info('No patches present in skymodel. Assigning every source an individual patch.')
-                skymodel.group('every')
-                skymodel.setPatchPositions(method='mid')
-            logger.root.setLevel(old_level)
-            self.skymodel = skymodel
+            key = (os.path.abspath(self.input_skymodel_filename),
+                   os.path.getmtime(self.input_skymodel_filename))
+            if key not in _skymodel_cache:
+                # Set logging level to suppress confusing output from lsmtool
+                old_level = logger.root.getEffectiveLevel()
+                logger.root.setLevel('WARNING')
+                skymodel = lsmtool.load(self.input_skymodel_filename)
+                if not skymodel.hasPatches:
+                    logger.info('No patches present in skymodel. Assigning every source an individual patch.')
+                    skymodel.group('every')
+                    skymodel.setPatchPositions(method='mid')
+                logger.root.setLevel(old_level)
+                # Keep only one sky model alive
+                _skymodel_cache.clear()
+                _skymodel_cache[key] = skymodel
+            # Copy, so changes to the sky model don't leak into the cache
+            self.skymodel = copy.deepcopy(_skymodel_cache[key])
         else:
             self.skymodel = None
 
@@ -259,25 +416,28 @@ class Observation:
     def get_patch_coords(self):
         """
         Returns arrays of flux-weighted mean RA, Dec in degrees for patches in the
-        sky model
+        sky model. The result is computed once and cached.
         """
-        if self.input_skymodel_type == 'makesourcedb':
-            coords = self.skymodel.getPatchPositions(asArray=True)
-        else:
-            ra, dec, _ = self.read_ds9_region_file(self.regions_filename)
-            coords = (ra, dec)
-        return coords
+        if self._patch_coords is None:
+            if self.input_skymodel_type == 'makesourcedb':
+                self._patch_coords = self.skymodel.getPatchPositions(asArray=True)
+            else:
+                ra, dec, _ = self.read_ds9_region_file(self.regions_filename)
+                self._patch_coords = (ra, dec)
+        return self._patch_coords
 
     def get_patch_names(self):
         """
-        Returns list of DP3-compatible patch names
+        Returns list of DP3-compatible patch names. The result is computed once
+        and cached.
         """
-        if self.input_skymodel_type == 'makesourcedb':
-            patch_names = ['[{}]'.format(p) for p in self.skymodel.getPatchNames()]
-        else:
-            _, _, facet_names = self.read_ds9_region_file(self.regions_filename)
-            patch_names = ['[{}]'.format(p) for p in facet_names]
-        return patch_names
+        if self._patch_names is None:
+            if self.input_skymodel_type == 'makesourcedb':
+                self._patch_names = [f'[{p}]' for p in self.skymodel.getPatchNames()]
+            else:
+                _, _, facet_names = self.read_ds9_region_file(self.regions_filename)
+                self._patch_names = [f'[{p}]' for p in facet_names]
+        return self._patch_names
 
     def initialize_parset_parameters(self):
         """
@@ -292,8 +452,7 @@ class Observation:
     def make_parset(self):
         """ Write the DP3 parset parameters to a text file """
         with open(self.parset_filename, 'w') as f:
-            for k, v in self.parset_parameters.items():
-                f.write('{0} = {1}\n'.format(k, v))
+            f.write(''.join(f'{k} = {v}\n' for k, v in self.parset_parameters.items()))
 
     def add_to_parset(self, stepname, soltabname, h5parmFilename='corruptions.h5', DDE=True):
         """
@@ -308,62 +467,67 @@ class Observation:
              during the h5parmpredict for all directions or in a applycal step.
         """
 
-        applyprefix = 'predict.applycal' if DDE else 'applycal'
+        ap = 'predict.applycal' if DDE else 'applycal'
+        parset = self.parset_parameters
         if DDE:
-            self.parset_parameters[applyprefix + '.parmdb'] = h5parmFilename
-            self.parset_parameters[applyprefix + '.correction'] = soltabname
-        else:
-            if 'applycal' not in self.parset_parameters['steps']:
-                self.parset_parameters['steps'].append('applycal')
-            self.parset_parameters[applyprefix + '.invert'] = 'false'
-            self.parset_parameters['applycal.type'] = 'applycal'
-        if applyprefix+'.steps' in self.parset_parameters:
-            self.parset_parameters[applyprefix+'.steps'].append(stepname)
+            parset[f'{ap}.parmdb'] = h5parmFilename
+            parset[f'{ap}.correction'] = soltabname
         else:
-            self.parset_parameters[applyprefix+'.steps'] = [stepname]
-        self.parset_parameters[applyprefix+'.{}.correction'.format(stepname)] = soltabname
-        self.parset_parameters[applyprefix+'.{}.parmdb'.format(stepname)] = h5parmFilename
+            if 'applycal' not in parset['steps']:
+                parset['steps'].append('applycal')
+            parset[f'{ap}.invert'] = 'false'
+            parset['applycal.type'] = 'applycal'
+        parset.setdefault(f'{ap}.steps', []).append(stepname)
+        parset.update({f'{ap}.{stepname}.correction': soltabname,
+                       f'{ap}.{stepname}.parmdb': h5parmFilename})
 
     def set_time(self):
         """ Set the time information. Also check wheter all the MS have
         matching time information."""
-        starttime, endtime, timepersample, numsamples = [], [], [], []
-        for ms in self:
-            starttime.append(ms.starttime)
-            endtime.append(ms.endtime)
-            timepersample.append(ms.timepersample)
-            numsamples.append(ms.numsamples)
-        if np.any([len(np.unique(_tms)) > 1 for _tms in [starttime, endtime,
-                                                         timepersample, numsamples]]):
+        m = self._ms_meta
+        mismatch = np.flatnonzero(m != m[0])
+        if len(mismatch):
             logger.critical("Time information of MS {} does not match!".format(
-                             ms.ms_filename))
+                             self.ms_list[mismatch[0]].ms_filename))
         else:
-            self.starttime = starttime[0]
-            self.endtime = endtime[0]
-            self.timepersample = timepersample[0]
-            self.numsamples = numsamples[0]
+            self.starttime = m['starttime'][0]
+            self.endtime = m['endtime'][0]
+            self.timepersample = m['timepersample'][0]
+            self.numsamples = int(m['numsamples'][0])
 
     def get_times(self):
-        """ Return array of times (ordered, with duplicates excluded). """
-        return self.starttime + np.arange(self.numsamples) * self.timepersample
+        """ Return array of times (ordered, with duplicates excluded). The
+        array is computed once and read-only. """
+        if self._times is None:
+            self._times = self.starttime + np.arange(self.numsamples) * self.timepersample
+            self._times.setflags(write=False)
+        return self._times
 
     def get_frequencies(self):
-        """ Return array of frequencies (ordered, duplicates excluded). """
-        sb_freq = np.array([ms.get_frequencies() for ms in self]).flatten()
-        if len(sb_freq) != len(np.unique(sb_freq)):
-            logger.warning('Some channels share the same frequency!')
-        return np.sort(sb_freq)
+        """ Return array of frequencies (ordered, duplicates excluded). The
+        array is computed once and read-only. """
+        if self._freqs is None:
+            # Copy the channels of every MS into one buffer and sort in place
+            offsets = np.cumsum([0] + [ms.numchannels for ms in self])
+            sb_freq = np.empty(offsets[-1], dtype=np.float64)
+            for ms, start, end in zip(self, offsets[:-1], offsets[1:]):
+                sb_freq[start:end] = ms.get_frequencies()
+            sb_freq.sort()
+            if (sb_freq[1:] == sb_freq[:-1]).any():
+                logger.warning('Some channels share the same frequency!')
+            sb_freq.setflags(write=False)
+            self._freqs = sb_freq
+        return self._freqs
 
     def set_stations(self):
         """ Set the station names and positions """
-        stations, stationpositions = [], []
-        for ms in self:
-            for _sn, _sp in zip(ms.stations, ms.stationpositions):
-                if _sn not in stations:
-                    stations.append(_sn)
-                    stationpositions.append(_sp)
-        self.stations = np.array(stations)
-        self.stationpositions = np.array(stationpositions)
+        all_names = np.concatenate([ms.stations for ms in self])
+        all_pos = np.concatenate([ms.stationpositions for ms in self], axis=0)
+        # Keep the first occurrence of every station, in order
+        _, idx = np.unique(all_names, return_index=True)
+        order = np.sort(idx)
+        self.stations = all_names[order]
+        self.stationpositions = all_pos[order]
 
     def reset_beam_keyword(self, colname='DATA'):
         """
@@ -375,14 +539,27 @@ class Observation:
             Name of column
         """
         for ms in self:
+            # Check on the read-only table, only open for writing if needed
+            with ms.table() as t:
+                if colname not in t.colnames() or 'LOFAR_APPLIED_BEAM_MODE' not in t.getcolkeywords(colname):
+                    continue
             with ms.table(readonly=False) as t:
-                if colname in t.colnames() and 'LOFAR_APPLIED_BEAM_MODE' in t.getcolkeywords(colname):
-                    t.putcolkeyword(colname, 'LOFAR_APPLIED_BEAM_MODE', 'None')
+                t.putcolkeyword(colname, 'LOFAR_APPLIED_BEAM_MODE', 'None')
+
+    def close(self):
+        """
+        Close the cached tables of all MSs
+        """
+        for ms in self:
+            ms.close()
 
     @staticmethod
+    @functools.lru_cache(maxsize=256)
     def convert_mjd(mjd_sec):
         """
-        Converts MJD to casacore MVTime
+        Converts MJD to casacore MVTime. Days have 86400 seconds, as in
+        casacore, so the string converts back to the same MJD seconds also on
+        days with a leap second (astropy UTC would stretch those days).
 
         Parameters
         ----------
@@ -394,18 +571,46 @@ class Observation:
         mvtime : str
             Casacore MVTime string
         """
-        t = Time(mjd_sec / 3600 / 24, format='mjd', scale='utc')
-        date, hour = t.iso.split(' ')
-        year, month, day = date.split('-')
-        d = t.datetime
-        month = d.ctime().split(' ')[1]
+        d = _MJD_EPOCH + datetime.timedelta(milliseconds=round(mjd_sec * 1000))
+        return (f'{d.day:02d}{_MONTHS[d.month-1]}{d.year}/'
+                f'{d.hour:02d}:{d.minute:02d}:{d.second:02d}.{d.microsecond//1000:03d}')
 
-        return '{0}{1}{2}/{3}'.format(day, month, year, hour)
+    @staticmethod
+    def is_fits(filename):
+        """
+        Check whether a file is a FITS file, from its first bytes if possible
+
+        Parameters
+        ----------
+        filename : str
+            Filename to check
+
+        Returns
+        -------
+        result : bool
+            True if the file is a FITS file
+        """
+        try:
+            with open(filename, 'rb') as f:
+                head = f.read(6)
+        except OSError:
+            return False
+        if head == b'SIMPLE':
+            return True
+        if head[:2] not in (b'\x1f\x8b', b'BZ', b'PK'):
+            return False
+        # Compressed file, let astropy decide
+        try:
+            with fits.open(filename):
+                return True
+        except OSError:
+            return False
 
     @staticmethod
     def read_ds9_region_file(region_file):
         """
-        Read a ds9 facet region file and return facet coordinates and names
+        Read a ds9 facet region file and return facet coordinates and names.
+        The result is cached until the file is modified.
 
         Parameters
         ----------
@@ -417,27 +622,63 @@ class Observation:
         facet_ra, facet_dec, facet_name : Numpy arrays
             Arrays of Facet coordinates and names
         """
-        facet_ra = []
-        facet_dec = []
-        facet_name = []
+        return _read_ds9_region_file(os.path.abspath(region_file),
+                                     os.path.getmtime(region_file))
+
+
+_POINT_RE = re.compile(r'point\s*\(\s*([-\d.eE+]+)\s*,\s*([-\d.eE+]+)\s*\)')
+
+
+def _region_number(s):
+    """
+    Return a coordinate of a region file as int or float, like the Python
+    literal it is written as, so default facet names keep their format
+    """
+    try:
+        return int(s)
+    except ValueError:
+        return float(s)
+
+
+@functools.lru_cache(maxsize=None)
+def _read_ds9_region_file(region_file, mtime):
+    """
+    Read a ds9 facet region file and return facet coordinates and names
+
+    Parameters
+    ----------
+    region_file : str
+        Filename of input ds9 region file
+    mtime : float
+        Modification time of the file, to invalidate the cache
+
+    Returns
+    -------
+    facet_ra, facet_dec, facet_name : Numpy arrays
+        Arrays of Facet coordinates and names
+    """
+    facet_ra = []
+    facet_dec = []
+    facet_name = []
 
-        with open(region_file, 'r') as f:
-            lines = f.readlines()
-        for line in lines:
+    with open(region_file, 'r') as f:
+        for line in f:
             # Each facet in the region file is defined by two consecutive lines:
             #   - the first starts with 'polygon' and gives the (RA, Dec) vertices
             #   - the second starts with 'point' and gives the reference (RA, Dec)
             #     and the facet name
-            if line.startswith('polygon'):
+            if not line.startswith('point'):
                 continue
-            if line.startswith('point'):
-                ra, dec = ast.literal_eval(line.split('point')[1])
-                if 'text' in line:
-                    name = line.split('text=')[1].strip()
-                else:
-                    name = f'facet_{ra}_{dec}'
-                facet_ra.append(ra)
-                facet_dec.append(dec)
-                facet_name.append(name)
-
-        return np.array(facet_ra), np.array(facet_dec), np.array(facet_name)
+            m = _POINT_RE.match(line)
+            if m is None:
+                raise ValueError(f'Cannot parse point in {region_file}: {line.strip()}')
+            ra, dec = _region_number(m.group(1)), _region_number(m.group(2))
+            if 'text' in line:
+                name = line.split('text=')[1].strip()
+            else:
+                name = f'facet_{ra}_{dec}'
+            facet_ra.append(float(ra))
+            facet_dec.append(float(dec))
+            facet_name.append(name)
+
+    return np.array(facet_ra), np.array(facet_dec), np.array(facet_name)
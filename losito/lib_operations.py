@@ -2,8 +2,54 @@
 """
 Libraries for operations
 """
-import os, multiprocessing, sys
+import os, re, mmap, multiprocessing, sys, functools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
 from .lib_io import logger
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:  # Python < 3.8
+    shared_memory = None
+
+# numpy arrays from this size on are passed to multiprocManager workers
+# through shared memory instead of being pickled
+_SHM_MIN_BYTES = 1 << 20
+
+# Per command type, a pattern that marks a failed run in the log and a
+# string that a successful log must contain (or None)
+_LOG_CHECKS = {
+    'DP3': (re.compile(rb'Exception|\*\*\*\* uncaught exception \*\*\*\*|misspelled'),
+            b'Finishing processing'),
+    'CASA': (re.compile(rb'[a-z]Error|An error occurred running|\*\*\* Error \*\*\*'), None),
+    'wsclean': (re.compile(rb'exception occured|Segmentation fault'),
+                b'Cleaning up temporary files...'),
+    'python': (re.compile(rb'Traceback \(most recent call last\):|(?i:critical)'
+                          rb'|^(?!.*(?i:error000)).*(?i:error)', re.MULTILINE), None),
+    'general': (re.compile(rb'(?i:error)'), None),
+}
+
+
+@functools.lru_cache(maxsize=1)
+def _detect_cluster():
+    """
+    Find in which computing cluster the pipeline is running. This is cached,
+    as the DNS lookup of getfqdn() can be slow.
+    """
+    import socket
+    hostname = socket.gethostname()
+    if (hostname in ['node31','node32','node33','node34','node35']):
+        return "Hamburg_fat"
+    dnsdomain = socket.getfqdn()
+    if 'lofar.gpu.cluster' in dnsdomain:
+        return "Hamburg"
+    elif ('leidenuniv' in hostname):
+        return "Leiden"
+    elif (hostname[0 : 3] == 'lof'):
+        return "CEP3"
+    else:
+        logger.warning('Hostname %s unknown.' % dnsdomain)
+        return "Unknown"
+
 
 class Scheduler():
     def __init__(self, qsub = None, maxThreads = None, max_processors = None, log_dir = 'logs', dry = False):
@@ -59,21 +105,7 @@ class Scheduler():
         """
         Find in which computing cluster the pipeline is running
         """
-        import socket
-        hostname = socket.gethostname()
-        dnsdomain = socket.getfqdn()
-        if (hostname in ['node31','node32','node33','node34','node35']):
-            return "Hamburg_fat"
-        elif 'lofar.gpu.cluster' in dnsdomain:
-              return "Hamburg"
-        elif ('leidenuniv' in hostname):
-            return "Leiden"
-        elif (hostname[0 : 3] == 'lof'):
-            return "CEP3"
-        else:
-            logger.warning('Hostname %s unknown.' % dnsdomain)
-            return "Unknown"
-
+        return _detect_cluster()
 
     def add(self, cmd = '', log = '', logAppend = True, commandType = '', processors = None):
         """
@@ -128,18 +160,13 @@ class Scheduler():
         If 'check' is True, a check is done on every log in 'self.log_list'.
         If max_thread != None, then it overrides the global values, useful for special commands that need a lower number of threads.
         """
-        from threading import Thread
-        from queue import Queue
         import subprocess
-        import gc
 
-        def worker(queue):
-            for cmd in iter(queue.get, None):
-                if self.qsub and self.cluster == "Hamburg":
-                    cmd = f'salloc --job-name LoSiTo --cpus-per-task {int(cmd[0])} --mem-per-cpu 5G --time=24:00:00 ' \
-                          f'--nodes=1 --tasks-per-node={6//int(cmd[0])} /usr/bin/srun --ntasks=1 --nodes=1 --preserve-env \'{cmd[1]}\''
-                gc.collect()
-                subprocess.call(cmd, shell = True)
+        def invoke(cmd):
+            if self.qsub and self.cluster == "Hamburg":
+                cmd = f'salloc --job-name LoSiTo --cpus-per-task {int(cmd[0])} --mem-per-cpu 5G --time=24:00:00 ' \
+                      f'--nodes=1 --tasks-per-node={6//int(cmd[0])} /usr/bin/srun --ntasks=1 --nodes=1 --preserve-env \'{cmd[1]}\''
+            subprocess.call(cmd, shell = True)
 
         # limit threads only when qsub doesn't do it
         if (maxThreads == None):
@@ -147,21 +174,9 @@ class Scheduler():
         else:
             maxThreads_run = min(maxThreads, self.maxThreads)
 
-        q       = Queue()
-        threads = [Thread(target = worker, args=(q,)) for _ in range(maxThreads_run)]
-
-        for i, t in enumerate(threads): # start workers
-            t.daemon = True
-            t.start()
-
-        for action in self.action_list:
-            if (self.dry):
-                continue # don't schedule if dry run
-            q.put_nowait(action)
-        for _ in threads:
-            q.put(None) # signal no more commands
-        for t in threads:
-            t.join()
+        if not self.dry: # don't schedule if dry run
+            with ThreadPoolExecutor(max_workers = maxThreads_run) as ex:
+                list(ex.map(invoke, self.action_list))
 
         # check outcomes on logs
         if (check):
@@ -176,77 +191,94 @@ class Scheduler():
     def check_run(self, log = "", commandType = ""):
         """
         Produce a warning if a command didn't close the log properly i.e. it crashed
-        NOTE: grep, -L inverse match, -l return only filename
+        The log is read once and checked against the patterns in _LOG_CHECKS
         """
-        import subprocess
-
         if (not os.path.exists(log)):
             logger.warning("No log file found to check results: " + log)
             return 1
 
-        if (commandType == "DP3"):
-            out = subprocess.check_output('grep -L "Finishing processing" '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-            out += subprocess.check_output('grep -l "Exception" '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-            out += subprocess.check_output('grep -l "**** uncaught exception ****" '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-            #out += subprocess.check_output('grep -l "error" '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-            out += subprocess.check_output('grep -l "misspelled" '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-
-        elif (commandType == "CASA"):
-            out = subprocess.check_output('grep -l "[a-z]Error" '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-            out += subprocess.check_output('grep -l "An error occurred running" '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-            out += subprocess.check_output('grep -l "\*\*\* Error \*\*\*" '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-
-        elif (commandType == "wsclean"):
-            out = subprocess.check_output('grep -l "exception occured" '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-            out += subprocess.check_output('grep -l "Segmentation fault" '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-            out += subprocess.check_output('grep -L "Cleaning up temporary files..." '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-
-        elif (commandType == "python"):
-            out = subprocess.check_output('grep -l "Traceback (most recent call last):" '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-            out += subprocess.check_output('grep -i -l \'(?=^((?!error000).)*$).*Error.*\' '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-            out += subprocess.check_output('grep -i -l "Critical" '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-
-        elif (commandType == "general"):
-            out = subprocess.check_output('grep -l -i "error" '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-
-        else:
+        if commandType not in _LOG_CHECKS:
             logger.warning("Unknown command type for log checking: '" + commandType + "'")
             return 1
 
-        if out != b'':
-            out = out.split(b'\n')[0].decode()
-            logger.error(commandType+' run problem on:\n'+out)
-            raise RuntimeError(commandType+' run problem on:\n'+out)
+        failure, success = _LOG_CHECKS[commandType]
+        with open(log, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                failed = success is not None  # an empty file can't be mapped
+            else:
+                # scan the log through the page cache without copying it
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    failed = bool(failure.search(data)) or (success is not None and data.find(success) == -1)
+        if failed:
+            logger.error(commandType+' run problem on:\n'+log)
+            raise RuntimeError(commandType+' run problem on:\n'+log)
 
         return 0
 
 
-class multiprocManager(object):
-
-    class multiThread(multiprocessing.Process):
-        """
-        This class is a working thread which load parameters from a queue and
-        return in the output queue
-        """
-
-        def __init__(self, inQueue, outQueue, funct):
-            multiprocessing.Process.__init__(self)
-            self.inQueue = inQueue
-            self.outQueue = outQueue
-            self.funct = funct
-
-        def run(self):
+class _SharedArray(object):
+    """
+    Description of a numpy array in shared memory, sent to a multiprocManager
+    worker in place of the array
+    """
+    def __init__(self, name, shape, dtype):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+
+class _ListQueue(list):
+    """
+    Collects the results a function puts into its outQueue
+    """
+    put = list.append
+
+
+def _collect(funct, args):
+    """
+    Run funct and return the results it put into its outQueue. Arrays in
+    shared memory are attached as numpy views.
+    """
+    handles = []
+    args = list(args)
+    for i, a in enumerate(args):
+        if isinstance(a, _SharedArray):
+            shm = shared_memory.SharedMemory(name=a.name)
+            handles.append(shm)
+            args[i] = np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)
+    outQueue = _ListQueue()
+    try:
+        funct(*args, outQueue=outQueue)
+    finally:
+        del args
+        for shm in handles:
+            try:
+                shm.close()
+            except BufferError:  # funct kept a reference to the array
+                pass
+    return outQueue
+
+
+# function run by the jobs of a multiprocManager worker process
+_worker_funct = None
+
+
+def _set_worker_funct(funct):
+    """
+    Pool initializer, sends funct to each worker process once
+    """
+    global _worker_funct
+    _worker_funct = funct
+
+
+def _run_job(args):
+    """
+    Run a job with the function set by _set_worker_funct
+    """
+    return _collect(_worker_funct, args)
 
-            while True:
-                parms = self.inQueue.get()
 
-                # poison pill
-                if parms is None:
-                    self.inQueue.task_done()
-                    break
-
-                self.funct(*parms, outQueue=self.outQueue)
-                self.inQueue.task_done()
+class multiprocManager(object):
 
     def __init__(self, procs=0, funct=None):
         """
@@ -258,41 +290,77 @@ class multiprocManager(object):
         if procs == 0:
             procs = multiprocessing.cpu_count()
         self.procs = procs
-        self._threads = []
-        self.inQueue = multiprocessing.JoinableQueue()
-        manager = multiprocessing.Manager()
-        self.outQueue = manager.Queue()
-        self.runs = 0
-
-        logger.debug('Spawning %i threads...' % self.procs)
-        for proc in range(self.procs):
-            t = self.multiThread(self.inQueue, self.outQueue, funct)
-            self._threads.append(t)
-            t.start()
+        self.funct = funct
+        self._args = []
+        self._results = []
+        self._shm = []
+
+    def run(self, args_iter, chunksize=64):
+        """
+        Run funct for all the parameters in args_iter in a process pool, sending
+        them in chunks of chunksize jobs. This is an alternative to put/get/wait.
+        Return the results as an iterator, in the order of args_iter
+        """
+        with ProcessPoolExecutor(max_workers=self.procs,
+                                 mp_context=multiprocessing.get_context('fork'),
+                                 initializer=_set_worker_funct, initargs=(self.funct,)) as pool:
+            for results in pool.map(_run_job, args_iter, chunksize=chunksize):
+                yield from results
 
     def put(self, args):
         """
-        Parameters to give to the next jobs sent into queue
+        Parameters to give to the next jobs, run by wait()
+        """
+        self._args.append(self._share(args))
+
+    def put_batch(self, batch):
+        """
+        Parameters of several jobs, run by wait()
         """
-        self.inQueue.put(args)
-        self.runs += 1
+        self._args.extend(self._share(args) for args in batch)
+
+    def _share(self, args):
+        """
+        Copy large numpy arrays in args to shared memory, so that only a
+        small description of them is pickled. They are freed by wait().
+        """
+        if shared_memory is None:
+            return args
+        shared = []
+        for a in args:
+            if isinstance(a, np.ndarray) and a.nbytes >= _SHM_MIN_BYTES and not a.dtype.hasobject:
+                if not self._shm:
+                    # Start the tracker before the workers so they all share it
+                    resource_tracker.ensure_running()
+                shm = shared_memory.SharedMemory(create=True, size=a.nbytes)
+                np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)[...] = a
+                self._shm.append(shm)
+                a = _SharedArray(shm.name, a.shape, a.dtype.str)
+            shared.append(a)
+        return tuple(shared)
 
     def get(self):
         """
         Return all the results as an iterator
         """
-        # NOTE: do not use queue.empty() check which is unreliable
-        # https://docs.python.org/2/library/multiprocessing.html
-        for run in range(self.runs):
-            yield self.outQueue.get()
+        yield from self._results
 
     def wait(self):
         """
-        Send poison pills to jobs and wait for them to finish
-        The join() should kill all the processes
+        Run all the jobs in a process pool and wait for them to finish
         """
-        for t in self._threads:
-            self.inQueue.put(None)
-
-        # wait for all jobs to finish
-        self.inQueue.join()
+        if self._args:
+            logger.debug('Spawning %i processes...' % self.procs)
+            # a few chunks per process balance the load with little IPC
+            chunksize = max(1, len(self._args) // (4 * self.procs))
+            with multiprocessing.get_context('fork').Pool(self.procs, initializer=_set_worker_funct,
+                                                          initargs=(self.funct,)) as pool:
+                for results in pool.imap_unordered(_run_job, self._args, chunksize=chunksize):
+                    self._results.extend(results)
+            self._args = []
+
+        # free the shared memory of the jobs
+        for shm in self._shm:
+            shm.close()
+            shm.unlink()
+        self._shm = []
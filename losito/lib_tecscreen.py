@@ -6,14 +6,15 @@ Created on Fri Jan 31 10:14:35 2020
 """
 import functools, os
 import numpy as np
-import multiprocessing as mp
-from numpy import sqrt, fft, random, pi
-from scipy.interpolate import RectBivariateSpline
+from numpy import sqrt, pi
+from scipy.interpolate import CubicSpline
+from scipy import ndimage
+import scipy.fft
 from scipy.special import gamma
 import astropy.units as u
 import astropy.coordinates as coord
 from astropy.time import Time
-from astropy.coordinates import EarthLocation, SkyCoord, ITRS
+from astropy.coordinates import SkyCoord, ITRS
 from .lib_io import progress, logger
 
 # Workaround for unavailable USNO server, both these mirrors work as May 2020
@@ -21,6 +22,14 @@ from astropy.utils import iers
 iers.Conf.iers_auto_url.set('https://datacenter.iers.org/data/9/finals2000A.all')
 #iers.Conf.iers_auto_url.set('ftp://cddis.gsfc.nasa.gov/pub/products/iers/finals2000A.all')
 R_earth = 6364.62e3
+# Max. number of (timestamp, direction) pairs transformed at once in get_PP_PD
+_PP_CHUNK_SIZE = 1 << 20
+# Padding of the grids in GridInterpolator, the boundary condition of the
+# prefilter decays by a factor 0.27 per pixel
+_SPLINE_PAD = 12
+# Max. number of transforms and of values per batch of FftScreen noise
+_NOISE_BATCH = 8
+_NOISE_BATCH_SIZE = 1 << 23
 
 def unit_vec(v):
     'Return unit vector of v w.r.t. last axis'
@@ -44,10 +53,12 @@ def geocentric_to_geodetic(points):
             R : (...,) ndarray
                 Corresponding radius.
     '''
-    R = np.linalg.norm(points, axis = -1)
-    lon = np.arctan2(points[...,1], points[...,0])
-    lat = np.arcsin(points[...,2]/R)
-    return np.moveaxis(np.array([lon, lat, R]), 0, -1)
+    LonLatR = np.empty(points.shape[:-1] + (3,))
+    R = LonLatR[...,2]
+    np.sqrt(np.einsum('...i,...i->...', points, points), out = R)
+    np.arctan2(points[...,1], points[...,0], out = LonLatR[...,0])
+    np.arcsin(points[...,2]/R, out = LonLatR[...,1])
+    return LonLatR
 
 
 def daytime_from_mjds(t):
@@ -60,10 +71,10 @@ def daytime_from_mjds(t):
     -------
     hours : (n,) ndarray. Daytime hours.
     '''
-    jd = Time(t/(3600.*24.), format = 'mjd')
-    hours = np.array([step.hour for step in jd.to_datetime()])
-    fracs = np.array([step.minute/60. for step in jd.to_datetime()])
-    return hours + fracs
+    # MJD days start at midnight, so the time of day follows from the
+    # seconds modulo one day. Truncate to whole minutes, as before.
+    minutes = np.floor(np.mod(np.asarray(t, dtype=np.float64), 86400.) / 60.)
+    return minutes / 60.
 
 def daytime_tec_modulation(t):
     ''' Get the tec modulation values corresponding to the daytime derived
@@ -116,52 +127,55 @@ def daytime_tec_modulation(t):
 
 def get_PP_PD_per_source(args):
     '''
-    Get the Pierce Points and the Pierce Directions for a single direction,
-    <m> stations as well as <n> timestamps. The idea is that this function
-    is used within a pool.map parallelization taking the individual directions
-    as arguments.
+    Get the Pierce Points and the Pierce Directions for <l> directions,
+    <m> stations and <n> timestamps with one batched coordinate transform.
+    get_PP_PD() calls this on chunks of directions.
     
     Parameters
     ----------
     args: list,
-        containing (sp, radec, time) obeying these definitions:
-        -sp : (m, 3) ndarray
+        containing (S, radec, itrs, hIon) obeying these definitions:
+        -S : (m, 3) ndarray
               Station positions in meters ITRS XYZ
-        -radec : (2,) ndarray
-              Source direction RA and DEC in degree
+        -radec : (l, 2) ndarray
+              Source directions RA and DEC in degree
         -itrs : (n,) ITRS frame object
               ITRS object, corresponding to timestamps in mjd seconds.
+        -hIon : float, Ionosphere height in m
             
     Returns
     -------
-    PP : (n, m, 3) ndarray
+    PP : (n, m, l, 3) ndarray
         Pierce points in geocentric ITRS. Unit: meter
-        The (n, m, 3) shape corresponds to (timestamp, station, xyz).
-    PD : (n, 3) ndarray
+        The (n, m, l, 3) shape corresponds to (timestamp, station, direction,
+        xyz).
+    PD : (n, l, 3) ndarray
         Pierce direction unit verctors in geocenric ITRS.
         The directions are oriented such that the point from the source
         towards earth.
-        The (n, 3) shape corresponds to (timestamp, xyz). Since the coord sys
-        is geocentric and not horizontal, the source directions are the same
-        for every station.
+        The (n, l, 3) shape corresponds to (timestamp, direction, xyz).
+        Since the coord sys is geocentric and not horizontal, the source
+        directions are the same for every station.
     '''
-    sp, radec, itrs, hIon = args
-    direction = SkyCoord(radec[0], radec[1], frame=coord.FK5, unit=(u.deg, u.deg))
-    direction = direction.transform_to(itrs) # this is bottleneck here
+    S, radec, itrs, hIon = args
+    direction = SkyCoord(radec[:,0], radec[:,1], frame=coord.FK5, unit=(u.deg, u.deg))
+    # broadcast the (l,) directions against the (n,) obstimes
+    direction = direction[np.newaxis,:].transform_to(itrs[:,np.newaxis]) # this is bottleneck here
     # TODO: The ITRS values seem to vary randomly each calculation?
-    PD = np.array([direction.x, direction.y, direction.z]).T # source direction unit vector in itrs
-    S = np.array([sp.x.value, sp.y.value, sp.z.value]) # station position in itrs, [m]
-    alpha = -(PD @ S) + np.sqrt((PD @ S)**2 + (R_earth + hIon)**2 - (S**2).sum(0))
-    PP = S.T[np.newaxis,:,:] + alpha[:,:,np.newaxis] * PD[:,np.newaxis,:]
+    # source direction unit vectors in itrs
+    PD = np.stack([direction.x.value, direction.y.value, direction.z.value], axis=-1)
+    PDdotS = np.einsum('nlx,mx->nml', PD, S)
+    alpha = -PDdotS + np.sqrt(PDdotS**2 + (R_earth + hIon)**2 - (S**2).sum(1)[:,np.newaxis])
+    PP = S[np.newaxis,:,np.newaxis,:] + alpha[...,np.newaxis] * PD[:,np.newaxis,:,:]
     # pierce directions are defined as going from receiver to source
     return PP, PD
 
-def get_PP_PD(sp, directions, times, hIon, ncpu):
+def get_PP_PD(sp, directions, times, hIon, ncpu=None):
     ''' 
-    This is a wrapper function to parallelize get_PP_PD_per_source()
-    and unpack the return.
     Get the Pierce Points and the Pierce Directions for <l> directions,
     <m> stations and <n> timestamps. 
+    All directions are transformed at once, in chunks that bound the memory
+    of the (timestamp, direction) coordinate transform.
     
     Parameters
     ----------
@@ -172,7 +186,8 @@ def get_PP_PD(sp, directions, times, hIon, ncpu):
     times : (n,) ndarray
         Array containing timestamps in mjd seconds.
     hIon : float, Ionosphere height in m
-    ncpu : int,
+    ncpu : int, optional. Accepted for backwards compatibility and ignored,
+        the directions are no longer processed in a process pool.
 
     Returns
     -------
@@ -187,17 +202,17 @@ def get_PP_PD(sp, directions, times, hIon, ncpu):
         Since the coord sys is geocentric and not horizontal, the source 
         directions are the same for every station.
     '''
-    sp = EarthLocation.from_geocentric(x = sp[:,0], y= sp[:,1], z = sp[:,2], unit = 'meter')
+    S = np.asarray(sp, dtype=np.float64)
+    directions = np.atleast_2d(directions)
+    times = np.asarray(times)
     itrs = ITRS(obstime=Time(times/(3600*24), format = 'mjd'))
-    map_args = [(sp, d, itrs, hIon) for d in directions]
-    pool = mp.Pool(processes = ncpu)
-    PP_PD = pool.map(get_PP_PD_per_source, map_args)
-    pool.close() # w/o close+join: OSError: [Errno 12] Cannot allocate memory
-    pool.join()
-    # PP shaped as (timestamp, station, sources, xyz)
-    PP = np.array([u for (u,v) in PP_PD]).swapaxes(0,1).swapaxes(1,2)
-    # PD shaped as (timestamp, source, xyz)
-    PD = np.array([v for (u,v) in PP_PD]).swapaxes(0,1)
+    n, m, l = len(times), len(S), len(directions)
+    PP = np.empty((n, m, l, 3))
+    PD = np.empty((n, l, 3))
+    chunk = max(1, _PP_CHUNK_SIZE // max(n, 1))
+    for i in range(0, l, chunk):
+        PP[:,:,i:i+chunk], PD[:,i:i+chunk] = get_PP_PD_per_source(
+            (S, directions[i:i+chunk], itrs, hIon))
     return PP, PD
 
 
@@ -235,8 +250,11 @@ def screen_grid_comoving(edges, angRes, hIon):
     mssng_px_ln = np.max(npixel_lon) - npixel_lon
     max_lat += mssng_px_lt * res_rad # Fill for timesteps where screen smaller
     max_lon += mssng_px_ln * res_lon # Fill for timesteps where screen smaller
-    grid_lat = np.linspace(min_lat, max_lat, np.max(npixel_lat)).T
-    grid_lon = np.linspace(min_lon, max_lon, np.max(npixel_lon)).T
+    # (time, grid) grids as outer products of the per-timestep extent
+    t_lat = np.linspace(0.0, 1.0, np.max(npixel_lat))
+    t_lon = np.linspace(0.0, 1.0, np.max(npixel_lon))
+    grid_lat = min_lat[:,np.newaxis] + (max_lat - min_lat)[:,np.newaxis] * t_lat
+    grid_lon = min_lon[:,np.newaxis] + (max_lon - min_lon)[:,np.newaxis] * t_lon
     # update resolution to get rid of rounding error
     cellsz_lat = (max_lat - min_lat) / np.max(npixel_lat)
     cellsz_lon = (max_lon - min_lon) / np.max(npixel_lon)
@@ -274,6 +292,7 @@ def comoving_tecscreen(sp, directions, times, hIon = 250.e3, vIon = 10,
         Daytime vTEC peak value for tec modulation in TECU.
     angRes : float, optional. Default = 60 arcseconds
         Angular resolution of the tecscreen grid as seen from a station.
+    ncpu : int, optional. Accepted for backwards compatibility and ignored.
     seed : int, optional. 
         Random seed to reproduce turbulence.
     expfolder: str, optional. Default = None.
@@ -285,12 +304,11 @@ def comoving_tecscreen(sp, directions, times, hIon = 250.e3, vIon = 10,
     TEC : (n, i, j) ndarray
         TECscreen time dependent grid, the axes are (time, lon, lat)
     '''    
-    if ncpu == 0:
-        ncpu = mp.cpu_count()
     # Find pierce points
-    PP, PD = get_PP_PD(sp, directions, times, hIon, ncpu)   
+    PP, PD = get_PP_PD(sp, directions, times, hIon)   
     PP_llr = geocentric_to_geodetic(PP)
-    cos_pierce = (unit_vec(PP)*unit_vec(PD)[:,np.newaxis]).sum(-1)
+    # PD are unit vectors, so cos(pierce_angle) = PP*PD/|PP|
+    cos_pierce = np.einsum('nmlx,nlx->nml', PP, PD) / PP_llr[...,2]
     # Find the outermost piercepoints to define tecscreen size:
     edges = np.array([np.min(PP_llr[..., 0], axis=(1,2)),
                       np.max(PP_llr[..., 0], axis=(1,2)),
@@ -317,13 +335,21 @@ def comoving_tecscreen(sp, directions, times, hIon = 250.e3, vIon = 10,
            [len(grid_lon[0]), len(grid_lat[0])], dx = dx, theta = 0, seed = seed, numIter = len(times))
     TEC = np.zeros((len(times), len(sp), len(directions)))
 
+    # The grids are uniform, so the pierce points are interpolated at their
+    # pixel coordinates on the screen of each timestep. GridInterpolator
+    # clamps points that fall (by rounding) outside a grid to its edge, as
+    # the RectBivariateSpline used before did.
+    px_lon = ((PP_llr[...,0] - grid_lon[:,0,np.newaxis,np.newaxis])
+              / (grid_lon[:,1] - grid_lon[:,0])[:,np.newaxis,np.newaxis])
+    px_lat = ((PP_llr[...,1] - grid_lat[:,0,np.newaxis,np.newaxis])
+              / (grid_lat[:,1] - grid_lat[:,0])[:,np.newaxis,np.newaxis])
+
     # differential TEC from screen
     for i, tecsc in enumerate(sc_gen):
         progress(i, len(times), status='Generating tecscreen')        
         # Interpolate screen for each time and get values at pierce points
         tecsc /= 56.32 # transformation from PHASE at 150MHz to dTEC (to make difdractive scale r0 physical)
-        sc_interp = RectBivariateSpline(grid_lon[i], grid_lat[i], tecsc)
-        TEC_ti = sc_interp.ev(PP_llr[i,:,:,0], PP_llr[i,:,:,1])
+        TEC_ti = GridInterpolator(tecsc)(px_lon[i], px_lat[i])
         # slant TEC from pierce angle: (e_r*e_d)^-1 = cos(pierce_angle)^-1
         TEC[i] = TEC_ti/cos_pierce[i]       
         if expfolder: # export screen data for plotting
@@ -373,13 +399,14 @@ def delta_z(nu, z, h_iono=250e3, nu_plasma=10e6, delta_h=50e3):
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 def FrequencyGrid(shape, pixelSize=1.0):
     """Return a 2-d grid with absolute frequency relevant to an FFT of a
-    grid of pixels of size pixelSize."""
+    grid of pixels of size pixelSize. Single precision is sufficient for
+    the screens and halves their memory."""
     return sqrt(
         np.add.outer(
             np.fft.fftfreq(shape[0], pixelSize) ** 2,
             np.fft.fftfreq(shape[1], pixelSize) ** 2,
         )
-    )
+    ).astype(np.float32)
 
 
 def VonKarmanSpectrum(f, r0, L0=1e6, alpha=11.0 / 3.0):
@@ -414,15 +441,24 @@ def FftScreen(spectrum, shape, pixelSize=1.0, seed = 0):
         2D array of phase disturbances
     """
     f = FrequencyGrid(shape, pixelSize)
-    filter = sqrt(spectrum(f) * f[0, 1] * f[1, 0])
+    filter = sqrt(spectrum(f) * f[0, 1] * f[1, 0]).astype(np.float32)
     if seed == 0:
         seed = np.random.randint(0, 10000)
-    random.seed(int(seed))
+    rng = np.random.default_rng(int(seed))
+    # The complex FFT of two real noise fields packed as real and imaginary
+    # part gives two independent screens per transform.
+    packed = np.empty(filter.shape, dtype=np.complex64)
+    # white noise for several transforms is drawn at once
+    noise = np.empty((max(1, min(_NOISE_BATCH, _NOISE_BATCH_SIZE // (2 * filter.size))), 2)
+                     + filter.shape, dtype=np.float32)
     while 1:
-        sample = random.normal(size=(2,) + filter.shape)
-        result = fft.fft2(filter * (sample[0] + 1j * sample[1]))
-        yield result.real
-        yield result.imag
+        rng.standard_normal(out=noise, dtype=np.float32)
+        for sample in noise:
+            np.multiply(filter, sample[0], out=packed.real)
+            np.multiply(filter, sample[1], out=packed.imag)
+            result = scipy.fft.fft2(packed, workers=-1)
+            yield result.real
+            yield result.imag
 
 
 def SplineTiles(tileGenerator):
@@ -432,8 +468,8 @@ def SplineTiles(tileGenerator):
     previous = next(tileGenerator)
     n0 = previous.shape[0] // 2
     assert n0 * 2 == previous.shape[0]
-    cspline = np.cos(np.linspace(0, pi / 2, n0, endpoint=False))
-    sspline = np.sin(np.linspace(0, pi / 2, n0, endpoint=False))
+    cspline = np.cos(np.linspace(0, pi / 2, n0, endpoint=False, dtype=previous.dtype))
+    sspline = np.sin(np.linspace(0, pi / 2, n0, endpoint=False, dtype=previous.dtype))
     for current in tileGenerator:
         yield previous[n0:] * cspline[:, np.newaxis] + current[:n0] * sspline[
             :, np.newaxis
@@ -442,11 +478,33 @@ def SplineTiles(tileGenerator):
 
 
 def GridInterpolator(grid):
-    xgrid = np.arange(grid.shape[0])
-    ygrid = np.arange(grid.shape[1])
+    """Return a cubic spline interpolator of grid at pixel coordinates.
+    This replaces a not-a-knot RectBivariateSpline fit of the grid, but is
+    evaluated much faster with ndimage.map_coordinates: the grid is padded
+    with the extrapolated end polynomials of the spline and prefiltered once.
+    Within the grid, the result agrees with RectBivariateSpline to ~1e-4 of
+    the standard deviation of the grid (float64). Coordinates outside the
+    grid are clipped to its edges, as FITPACK does.
+    """
+    pad = _SPLINE_PAD
+    nx, ny = grid.shape
+    for axis in (0, 1):
+        n = grid.shape[axis]
+        # The end polynomials hardly depend on data further than 2*pad pixels
+        # away, so only the edges of the grid are fitted.
+        edge = min(n, 2 * pad)
+        head = CubicSpline(np.arange(edge), np.take(grid, range(edge), axis=axis), axis=axis)
+        tail = CubicSpline(np.arange(n - edge, n), np.take(grid, range(n - edge, n), axis=axis), axis=axis)
+        grid = np.concatenate([head(np.arange(-pad, 0)).astype(grid.dtype), grid,
+                               tail(np.arange(n, n + pad)).astype(grid.dtype)], axis=axis)
+    # keep the precision of the grid, e.g. single precision screens
+    coeffs = ndimage.spline_filter(grid, order=3, output=grid.dtype, mode='mirror')
     def interpolator(x, y, grid = False):
-        pass 
-    return RectBivariateSpline(xgrid, ygrid, grid)
+        x = np.clip(x, 0, nx - 1) + pad
+        y = np.clip(y, 0, ny - 1) + pad
+        return ndimage.map_coordinates(coeffs, [x, y], order=3, mode='mirror',
+                                       prefilter=False)
+    return interpolator
 
 
 def SlidingPixels(tileGenerator, x, y, dx):
@@ -473,12 +531,13 @@ def SlidingPixels(tileGenerator, x, y, dx):
     for i in range(numTile):
         tiles.append(next(tileGenerator))
     interpolator = GridInterpolator(np.concatenate(tiles))
-    xoffset = -xmin
-    ynew = y - np.amin(y)
+    xbase = x - xmin
+    ybase = y - np.amin(y)
+    xoffset = 0.0
     while True:
-        yield interpolator(x + xoffset, ynew, grid=False)
+        yield interpolator(xbase + xoffset, ybase, grid=False)
         xoffset += dx
-        if xoffset + xmin > xtile:
+        if xoffset > xtile:
             tiles.pop(0)
             tiles.append(next(tileGenerator))
             interpolator = GridInterpolator(np.concatenate(tiles))
@@ -521,8 +580,8 @@ def SlidingWindows(
         for origin in origins
     ]
     coords = np.array(coords)
-    x = coords[:, 0, :].flat
-    y = coords[:, 1, :].flat
+    x = np.ascontiguousarray(coords[:, 0, :].ravel())
+    y = np.ascontiguousarray(coords[:, 1, :].ravel())
     numWindow = len(origins)
     if numWindow == 1:
         newshape = shape
@@ -55,7 +55,7 @@ def SEFD(ms, station1, station2, freq):
         return np.repeat(SEFD, len(station1))  # SEFD same for all BL
     elif 'HBA' in ms.antennatype:
         # For HBA, the SEFD differs between core and remote stations
-        names = np.array([_n[0:2] for _n in ms.stations])
+        names = ms.stations.astype('U2')  # truncates to the first two characters
         CSids = ms.stationids[np.where(names =='CS')]
         lim = np.max(CSids)  # this id separates the core/remote stations
 
@@ -71,27 +71,25 @@ def SEFD(ms, station1, station2, freq):
 
 def add_noise_to_ms(ms, column='DATA', factor=1.0):
     # TODO: ensure eta = 1 is appropriate
-    tab = ms.table(readonly=False)
     eta = 0.95  # system efficiency. Roughly 1.0
-
-    chan_width = ms.channelwidth
-    freq = ms.get_frequencies()
-    ant1 = tab.getcol('ANTENNA1')
-    ant2 = tab.getcol('ANTENNA2')
-    exposure = ms.timepersample
-    # std = eta * SEFD(ms, ant1, ant2, freq) #TODO
-    # Iterate over frequency channels to save memory.
-    for i, nu in enumerate(freq):
-        # find correct standard deviation from SEFD
-        std = factor * (eta**-1) * SEFD(ms, ant1, ant2, nu)
-        std /= np.sqrt(2 * exposure * chan_width[i])
-        # draw complex valued samples of shape (row, corr_pol)
-        noise = np.random.normal(loc=0, scale=std, size=[4, *np.shape(std)]).T
-        noise = noise + 1.j * np.random.normal(loc=0, scale=std, size=[4, *np.shape(std)]).T
-        noise = noise[:, np.newaxis, :]
-        prediction = tab.getcolslice(column, blc=[i, -1], trc=[i, -1])
-        tab.putcolslice(column, prediction + noise, blc=[i, -1], trc=[i, -1])
-    tab.close()
+    with ms.table(readonly=False) as tab:
+        chan_width = ms.channelwidth
+        freq = ms.get_frequencies()
+        ant1 = tab.getcol('ANTENNA1')
+        ant2 = tab.getcol('ANTENNA2')
+        exposure = ms.timepersample
+        # std = eta * SEFD(ms, ant1, ant2, freq) #TODO
+        # Iterate over frequency channels to save memory.
+        for i, nu in enumerate(freq):
+            # find correct standard deviation from SEFD
+            std = factor * (eta**-1) * SEFD(ms, ant1, ant2, nu)
+            std /= np.sqrt(2 * exposure * chan_width[i])
+            # draw complex valued samples of shape (row, corr_pol)
+            noise = np.random.normal(loc=0, scale=std, size=[4, *np.shape(std)]).T
+            noise = noise + 1.j * np.random.normal(loc=0, scale=std, size=[4, *np.shape(std)]).T
+            noise = noise[:, np.newaxis, :]
+            prediction = tab.getcolslice(column, blc=[i, -1], trc=[i, -1])
+            tab.putcolslice(column, prediction + noise, blc=[i, -1], trc=[i, -1])
 
     return 0
 
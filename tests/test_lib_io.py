@@ -0,0 +1,119 @@
+"""
+Tests for lib_io, checked against the ConfigParser based parser it replaced
+"""
+import os
+from configparser import ConfigParser
+
+import pytest
+
+from losito.lib_io import ParsetParser
+
+EXAMPLE_PARSET = os.path.join(os.path.dirname(__file__), '..', 'examples', 'example.parset')
+
+PARSET = """# comment
+msin = a.MS b.MS
+ncpu = 4
+
+[step1]
+operation = TEC ; inline comment
+values = [1, 2,3]
+flags = [True, false, 0, yes]
+scale = 1.5e3
+multi = first
+    second
+name = 'quoted'
+"""
+
+
+def baseline_parser(parsetFile):
+    # the parser before the single-pass tokenizer
+    parser = ConfigParser(inline_comment_prefixes=('#', ';'))
+    with open(parsetFile) as f:
+        parser.read_string('[_global]\n' + f.read())
+    return parser
+
+
+@pytest.fixture
+def parset(tmp_path):
+    filename = tmp_path / 'test.parset'
+    filename.write_text(PARSET)
+    return str(filename)
+
+
+@pytest.mark.parametrize('which', ['example', 'test'])
+def test_parse_like_configparser(which, parset):
+    filename = EXAMPLE_PARSET if which == 'example' else parset
+    new, old = ParsetParser(filename), baseline_parser(filename)
+    assert new.sections() == old.sections()
+    for section in old.sections():
+        assert dict(new.items(section)) == dict(old.items(section))
+
+
+def test_getters(parset):
+    parser = ParsetParser(parset)
+    old = baseline_parser(parset)
+    assert parser.getstr('step1', 'name') == 'quoted'
+    assert parser.getint('_global', 'ncpu') == old.getint('_global', 'ncpu')
+    assert parser.getfloat('step1', 'scale') == old.getfloat('step1', 'scale')
+    assert parser.getstr('step1', 'Operation') == 'TEC'
+    assert parser.getarrayint('step1', 'values') == [1, 2, 3]
+    assert parser.getarrayfloat('step1', 'values') == [1., 2., 3.]
+    # arrays are cached, the returned lists must be independent copies
+    parser.getarray('step1', 'values').append('4')
+    assert parser.getarray('step1', 'values') == ['1', '2', '3']
+    assert parser.getint('step1', 'missing', 7) == 7
+
+
+def test_getarraybool(parset):
+    # Intended difference: the baseline returned bool(str), so 'false' and
+    # '0' were True. The strings are now mapped like getbool().
+    parser = ParsetParser(parset)
+    assert parser.getarraybool('step1', 'flags') == [True, False, False, True]
+    assert parser.getarraybool('step1', 'missing', [True, False]) == [True, False]
+    # strings that are no booleans are an error instead of True
+    assert parser.getarraybool('step1', 'values') is None
+
+
+def test_percent_is_raw(tmp_path):
+    # Intended difference: values are read without interpolation. The
+    # baseline raised for a bare '%' and turned '%%' into '%'.
+    filename = tmp_path / 'percent.parset'
+    filename.write_text('[step]\nfmt = 50%\nesc = 100%%\n')
+    parser = ParsetParser(str(filename))
+    assert parser.getstr('step', 'fmt') == '50%'
+    assert parser.getstr('step', 'esc') == '100%%'
+    assert baseline_parser(str(filename)).get('step', 'esc') == '100%'
+
+
+def test_cache_invalidated_on_change(parset):
+    assert ParsetParser(parset).getint('_global', 'ncpu') == 4
+    with open(parset, 'a') as f:
+        f.write('extra = 1\n')
+    stat = os.stat(parset)
+    os.utime(parset, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+    assert ParsetParser(parset).getint('step1', 'extra') == 1
+
+
+@pytest.mark.parametrize('content', [
+    '[s]\n  a = 1\n  b = 2\n',                  # indented options
+    '[s]\na = x\n\n  y\n\n\nb = 3\n',           # empty lines inside a value
+    '[s]\na = x\n    y\n      z\n  w\n',        # deeper and shallower continuations
+    '[s]\na = 1\n  # comment\n  2\n\n',         # comment inside a value
+    '[s]\n  a =\n    x\n  b = y ; c\n',         # empty first line of a value
+])
+def test_multiline_like_configparser(content, tmp_path):
+    filename = tmp_path / 'multiline.parset'
+    filename.write_text(content)
+    old = ConfigParser(inline_comment_prefixes=('#', ';'), interpolation=None)
+    old.read_string(content)
+    new = ParsetParser(str(filename))
+    assert dict(new.items('s')) == dict(old.items('s'))
+
+
+def test_getfilename_sees_new_files(tmp_path):
+    (tmp_path / 'a.MS').mkdir()
+    filename = tmp_path / 'files.parset'
+    filename.write_text('msin = {}\n'.format(tmp_path / '*.MS'))
+    assert len(ParsetParser(str(filename)).getfilename('_global', 'msin')) == 1
+    (tmp_path / 'b.MS').mkdir()
+    assert len(ParsetParser(str(filename)).getfilename('_global', 'msin')) == 2
@@ -0,0 +1,50 @@
+"""
+Tests for lib_observation, checked against the implementations they replaced
+"""
+import numpy as np
+import pytest
+
+pytest.importorskip('casacore.tables')
+pytest.importorskip('lsmtool')
+from astropy.time import Time
+
+from losito.lib_observation import Observation
+
+
+def baseline_convert_mjd(mjd_sec):
+    # the astropy based conversion
+    t = Time(mjd_sec / 3600 / 24, format='mjd', scale='utc')
+    date, hour = t.iso.split(' ')
+    year, month, day = date.split('-')
+    month = t.datetime.ctime().split(' ')[1]
+    return '{0}{1}{2}/{3}'.format(day, month, year, hour)
+
+
+@pytest.mark.parametrize('mjd_sec', [4.9e9, 4.9e9 + 0.4567, 5e9 + 12.3456,
+                                     57754 * 86400., 58000.999 * 86400])
+def test_convert_mjd(mjd_sec):
+    assert Observation.convert_mjd(mjd_sec) == baseline_convert_mjd(mjd_sec)
+
+
+def test_convert_mjd_leap_second_day():
+    # Intended difference: 2016-12-31 had a leap second. astropy spreads the
+    # MJD day over 86401 s, while casacore (and convert_mjd) use 86400 s, so
+    # the string maps back to the same MS time.
+    mjd_sec = 57753.5 * 86400
+    assert Observation.convert_mjd(mjd_sec) == '31Dec2016/12:00:00.000'
+    assert baseline_convert_mjd(mjd_sec) == '31Dec2016/12:00:00.500'
+
+
+def test_read_ds9_region_file(tmp_path):
+    region_file = tmp_path / 'facets.reg'
+    region_file.write_text('# Region file\n'
+                           'polygon(1,2,3,4)\n'
+                           'point(12, 13)\n'
+                           'polygon(1,2,3,4)\n'
+                           'point(12.50,-3.0)\n'
+                           'point(1e1, 2.0) # text=foo\n')
+    ra, dec, names = Observation.read_ds9_region_file(str(region_file))
+    np.testing.assert_array_equal(ra, [12., 12.5, 10.])
+    np.testing.assert_array_equal(dec, [13., -3., 2.])
+    # default names keep the coordinates as written in Python literals
+    assert list(names) == ['facet_12_13', 'facet_12.5_-3.0', 'foo']
@@ -0,0 +1,120 @@
+"""
+Tests for lib_tecscreen, checked against the implementations they replaced
+"""
+import numpy as np
+import pytest
+import astropy.units as u
+from astropy.coordinates import FK5, ITRS, SkyCoord
+from astropy.time import Time
+from scipy.interpolate import RectBivariateSpline
+
+from losito.lib_tecscreen import (FftScreen, FrequencyGrid, GridInterpolator, R_earth,
+                                  VonKarmanSpectrum, geocentric_to_geodetic, get_PP_PD)
+
+
+@pytest.mark.parametrize('shape', [(8, 9), (30, 40), (200, 180)])
+def test_grid_interpolator_in_range(shape):
+    # Within the grid, the padded ndimage spline matches the not-a-knot
+    # RectBivariateSpline fit to ~1e-4 of the grid standard deviation
+    rng = np.random.default_rng(0)
+    grid = rng.standard_normal(shape)
+    x = rng.uniform(0, shape[0] - 1, 2000)
+    y = rng.uniform(0, shape[1] - 1, 2000)
+    ref = RectBivariateSpline(np.arange(shape[0]), np.arange(shape[1]), grid)
+    np.testing.assert_allclose(GridInterpolator(grid)(x, y), ref.ev(x, y), rtol=0, atol=1e-4)
+
+
+def test_grid_interpolator_out_of_range():
+    # Points outside the grid are clipped to its edges, as FITPACK does
+    rng = np.random.default_rng(1)
+    grid = rng.standard_normal((30, 40))
+    x = rng.uniform(-20, 50, 2000)
+    y = rng.uniform(-20, 60, 2000)
+    ref = RectBivariateSpline(np.arange(30), np.arange(40), grid)
+    np.testing.assert_allclose(GridInterpolator(grid)(x, y), ref.ev(x, y), rtol=0, atol=1e-4)
+
+
+def test_grid_interpolator_keeps_single_precision():
+    grid = np.random.default_rng(2).standard_normal((50, 60))
+    x, y = np.array([0., 10.5, 49.]), np.array([0., 20.25, 59.])
+    result = GridInterpolator(grid.astype(np.float32))(x, y)
+    assert result.dtype == np.float32
+    np.testing.assert_allclose(result, GridInterpolator(grid)(x, y), rtol=0, atol=1e-5)
+
+
+def baseline_PP_PD(sp, directions, times, hIon):
+    # the per-direction implementation that ran in a process pool
+    itrs = ITRS(obstime=Time(times/(3600*24), format='mjd'))
+    PP, PD = [], []
+    for radec in directions:
+        direction = SkyCoord(radec[0], radec[1], frame=FK5, unit=(u.deg, u.deg)).transform_to(itrs)
+        pd = np.array([direction.x, direction.y, direction.z]).T
+        S = sp.T
+        alpha = -(pd @ S) + np.sqrt((pd @ S)**2 + (R_earth + hIon)**2 - (S**2).sum(0))
+        PP.append(S.T[np.newaxis,:,:] + alpha[:,:,np.newaxis] * pd[:,np.newaxis,:])
+        PD.append(pd)
+    return np.array(PP).swapaxes(0, 1).swapaxes(1, 2), np.array(PD).swapaxes(0, 1)
+
+
+def test_get_PP_PD_matches_baseline():
+    rng = np.random.default_rng(3)
+    sp = np.array([3826896.235, 460979.455, 5064658.203]) + rng.normal(0, 3e4, (4, 3))
+    directions = np.column_stack([rng.uniform(120, 130, 3), rng.uniform(40, 50, 3)])
+    times = 4.9e9 + np.arange(0, 3600, 300.)
+    PP, PD = get_PP_PD(sp, directions, times, 250e3)
+    PP_ref, PD_ref = baseline_PP_PD(sp, directions, times, 250e3)
+    assert PP.shape == (len(times), len(sp), len(directions), 3)
+    assert PD.shape == (len(times), len(directions), 3)
+    np.testing.assert_allclose(PP, PP_ref, rtol=0, atol=1e-6)  # meter
+    np.testing.assert_allclose(PD, PD_ref, rtol=0, atol=1e-12)
+
+
+def test_geocentric_to_geodetic():
+    points = np.random.default_rng(4).normal(0, 6.4e6, (5, 2, 3))
+    llr = geocentric_to_geodetic(points)
+    R = np.linalg.norm(points, axis=-1)
+    np.testing.assert_allclose(llr[..., 0], np.arctan2(points[..., 1], points[..., 0]))
+    np.testing.assert_allclose(llr[..., 1], np.arcsin(points[..., 2] / R))
+    np.testing.assert_allclose(llr[..., 2], R)
+
+
+def spectrum(f):
+    return VonKarmanSpectrum(f, 30, 3000)
+
+
+def test_fft_screen_stream():
+    # Intended difference: the noise comes from np.random.default_rng(seed)
+    # in single precision, not from the legacy global RandomState, so a seed
+    # gives other screens than before. They are still reproducible.
+    shape = (64, 64)
+    screens = FftScreen(spectrum, shape, seed=7)
+    result = [next(screens) for i in range(4)]
+    f = FrequencyGrid(shape).astype(np.float64)
+    filter = np.sqrt(spectrum(f) * f[0, 1] * f[1, 0])
+    noise = np.random.default_rng(7).standard_normal((8, 2) + shape, dtype=np.float32)
+    for i in range(2):
+        ref = np.fft.fft2(filter * (noise[i, 0] + 1j * noise[i, 1]))
+        scale = np.abs(ref).max()
+        assert result[2*i].dtype == np.float32
+        np.testing.assert_allclose(result[2*i], ref.real, rtol=0, atol=1e-5 * scale)
+        np.testing.assert_allclose(result[2*i+1], ref.imag, rtol=0, atol=1e-5 * scale)
+
+
+def test_fft_screen_reproducible():
+    a = FftScreen(spectrum, (32, 32), seed=11)
+    b = FftScreen(spectrum, (32, 32), seed=11)
+    c = FftScreen(spectrum, (32, 32), seed=12)
+    first = [next(a) for i in range(20)]
+    for screen in first:
+        np.testing.assert_array_equal(screen, next(b))
+    assert not np.allclose(first[0], next(c))
+
+
+def test_frequency_grid_single_precision():
+    # The single precision filter keeps the screen power of double precision
+    f = FrequencyGrid((128, 128))
+    assert f.dtype == np.float32
+    f64 = f.astype(np.float64)
+    power = (np.sqrt(spectrum(f) * f[0, 1] * f[1, 0]).astype(np.float64)**2).sum()
+    power64 = (spectrum(f64) * f64[0, 1] * f64[1, 0]).sum()
+    assert abs(power / power64 - 1) < 1e-5